@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 
+import collections
+import functools
+import hashlib
+import itertools
 import os
+import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from distutils.spawn import find_executable
 from tarfile import TarFile
 from zipfile import ZipFile
-from tempfile import TemporaryDirectory
+from tempfile import (SpooledTemporaryFile, TemporaryDirectory, TemporaryFile,
+                      mkstemp)
 
 try:
     from conda_build.metadata import MetaData
@@ -17,18 +26,57 @@ except ImportError:
     print('Missing conda-build:\n\t$ conda install conda-build')
     exit(1)
 
+try:
+    import pygit2
+except ImportError:
+    # Optional: history walks fall back to running git
+    pygit2 = None
+
 if not find_executable('sloccount'):
     print('Missing sloccount:\n\thttps://www.dwheeler.com/sloccount/')
     exit(1)
 
 BAD_MAGIC = 0xFACEFEED
+_MASK32 = 0xFFFFFFFF
 ESCAPE_CHARS = '\\;&|'
+# Matches "<tag>.dev<N>" and astropy's "<tag>dev<N>"
+_DEV_VERSION = re.compile(r'(.+?)(\.?)dev(\d+)')
+_UNSAFE = re.compile('[{0}]'.format(re.escape(ESCAPE_CHARS)))
+MAX_DOWNLOADS = 16
+MAX_CLONES = 8
+DOWNLOAD_BUFSIZE = 128 * 1024
+SPOOL_MAX = 5 * 1024 * 1024
+TAR_BUFSIZE = 2 * 1024 * 1024
+MAX_EXTRACT_WORKERS = 32
+# Larger members are streamed to disk by the reading thread
+POOLED_FILE_MAX = 1024 * 1024
+# Upper bound on file data read from a tarball but not yet written
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+WRITE_BATCH = 32
+# A batch is also submitted once it holds this much file data
+WRITE_BATCH_BYTES = 1024 * 1024
+META_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME')
+                          or os.path.join(os.path.expanduser('~'), '.cache'),
+                          'build_reconstructor', 'meta')
+# Set BR_META_CACHE=0 to always download and extract package recipes
+META_CACHE_ENABLED = os.environ.get('BR_META_CACHE', '1') != '0'
+# Set BR_VERBOSE=1 to echo each external command before it runs
+VERBOSE = os.environ.get('BR_VERBOSE', '0') != '0'
+
+# conda-build's recipe renderer is not safe to drive from several threads
+_metadata_lock = threading.Lock()
 
 
 class GitError(Exception):
     pass
 
 class Package(object):
+    __slots__ = ('filename', 'remote_file', 'old_behavior', 'source_type',
+                 'metadata')
+
+    META_TEMPLATE_TARGET = 'info/recipe/meta.yaml.template'
+    META_TARGET = 'info/recipe/meta.yaml'
+
     def __init__(self, filename):
         valid_uris = ['file:', 'http:', 'https:']
         self.filename = filename
@@ -45,69 +93,89 @@ class Package(object):
             if not os.path.exists(self.filename):
                 raise FileNotFoundError(self.filename)
 
-        self.META_TEMPLATE_TARGET = 'info/recipe/meta.yaml.template'
-        self.META_TARGET = 'info/recipe/meta.yaml'
         self.metadata = self._populate_metadata()
 
+    def _open(self):
+        '''Return a readable file object containing the package tarball'''
+        if self.remote_file:
+            return spool(self.filename)
+
+        return open(self.filename, 'rb')
+
+    def _cache_key(self):
+        '''Key remote packages by URL and local ones by stat().'''
+        if self.filename.startswith(('http:', 'https:')):
+            ident = self.filename
+        else:
+            # conda-bld channels behind file: URLs are rebuilt in place
+            path = self.filename
+            if path.startswith('file:'):
+                path = urllib.request.url2pathname(
+                    urllib.parse.urlparse(path).path)
+
+            st = os.stat(path)
+            ident = '{0}:{1}:{2}'.format(os.path.abspath(path), st.st_size,
+                                         st.st_mtime_ns)
+
+        return hashlib.sha256(ident.encode()).hexdigest()
+
     def _populate_metadata(self):
+        key = self._cache_key() if META_CACHE_ENABLED else None
+        if key and os.path.exists(meta_cache_path(key)):
+            return load_metadata(key)
+
         with TemporaryDirectory() as tempdir:
-            meta_src = os.path.join(tempdir, self.META_TEMPLATE_TARGET)
-            meta_dest = os.path.join(tempdir, self.META_TARGET)
-            tarball_dest = os.path.join(tempdir,
-                                        os.path.basename(self.filename))
+            meta_dest = os.path.join(tempdir, 'meta.yaml')
 
-            if self.remote_file:
-                download(self.filename, tarball_dest)
+            with self._open() as fp:
+                print('Extracting {0}'.format(self.filename))
+                # Older versions of conda-build only provide META_TARGET
+                found = extract_member(fp, (self.META_TEMPLATE_TARGET,
+                                            self.META_TARGET), meta_dest)
 
-            print('Extracting {0}'.format(tarball_dest))
-            try:
-                with TarFile.open(tarball_dest, 'r:*') as tarball:
-                    tarball.extract(self.META_TEMPLATE_TARGET, tempdir)
-            except KeyError:
-                try:
-                    # Older version of conda-build: Use META_TARGET instead
-                    self.old_behavior = True
-                    with TarFile.open(tarball_dest, 'r:*') as tarball:
-                        tarball.extract(self.META_TARGET, tempdir)
-                except KeyError:
-                    print('Proprietary package lacks required data!')
-                    print()
-                    return None
-
-            if not self.old_behavior:
-                shutil.move(meta_src, meta_dest)
+            if found is None:
+                print('Proprietary package lacks required data!')
+                print()
+                return None
 
+            self.old_behavior = found == self.META_TARGET
             print()
-            return MetaData(meta_dest)
+            if not key:
+                return parse_metadata(meta_dest)
+
+            try:
+                store_metadata(key, meta_dest)
+            except OSError:
+                return parse_metadata(meta_dest)
+
+        return load_metadata(key)
 
     def version(self):
         global BAD_MAGIC
-        real_hash = False
 
-        _, base, _ = os.path.basename(self.filename).split('-')
+        # Package names may contain dashes; version and build never do
+        _, base, _ = os.path.basename(self.filename).rsplit('-', 2)
 
         if '+g' in base:
             tag, post_commit = base.split('+g')
-            real_hash = True
-        elif '.dev' in base:
-            tag, post_commit = base.split('.dev')
-        elif 'dev' in base:
-            # astropy is the ONLY package with this problem
-            # not surprised.
-            tag, post_commit = base.split('dev')
-            major, minor = tag.split('.')
-            major = int(major)
-            minor = int(minor)
-            minor -= 1
-            tag = 'v' + '.'.join([str(major), str(minor)])
-            post_commit = (int(post_commit) << 32) | BAD_MAGIC
-        else:
+            return tag, post_commit
+
+        match = _DEV_VERSION.fullmatch(base)
+        if match is None:
             return base, 0
 
-        if real_hash:
-            return tag, post_commit
+        tag, dot, post_commit = match.groups()
+        if dot:
+            return tag, int(post_commit)
 
-        return tag, int(post_commit)
+        # astropy is the ONLY package with this problem
+        # not surprised.
+        major, minor = tag.split('.')
+        major = int(major)
+        minor = int(minor)
+        minor -= 1
+        tag = 'v' + '.'.join([str(major), str(minor)])
+        return tag, (int(post_commit) << 32) | BAD_MAGIC
 
     def source_url(self):
         '''Only accounts for git repos and tarballs, beware.'''
@@ -138,6 +206,8 @@ class SpecFileFormatError(Exception):
 
 
 class SpecFile(object):
+    __slots__ = ('filename', 'urls', 'include_pkgs', 'include_urls')
+
     def __init__(self, filename, include_only=[], include_only_urls=[]):
         assert isinstance(include_only, list)
 
@@ -145,52 +215,37 @@ class SpecFile(object):
         self.urls = []
         self.include_pkgs = []
         self.include_urls = []
-        self.data = []
-
-        self.check_format()
 
-        with open(self.filename, 'r') as fp:
-            self.data = fp.read().splitlines()
+        prefixes = tuple(pattern + '-' for pattern in include_only)
+        explicit = False
 
-        if not self.data:
-            raise SpecFileError('Spec file contains no data.')
+        # Package filters take precedence over URL filters
+        if include_only:
+            self.urls = self.include_pkgs
+        elif include_only_urls:
+            self.urls = self.include_urls
+        unfiltered = not include_only and not include_only_urls
 
-        for url in self.data:
-            url = url.rstrip()
-            tarball = os.path.basename(url)
+        with open(self.filename, 'r') as fp:
+            for url in fp:
+                url = url.rstrip()
 
-            if not url or url.startswith('#') or url.startswith('@'):
-                continue
+                if not url or url.startswith(('#', '@')):
+                    explicit = explicit or '@EXPLICIT' in url
+                    continue
 
-            if include_only_urls:
-                for pattern in include_only_urls:
-                    if pattern in url:
-                        self.include_urls.append(url)
+                if unfiltered:
+                    self.urls.append(url)
+                    continue
 
-            if include_only:
-                for pattern in include_only:
-                    if tarball.startswith(pattern + '-'):
-                        # If URL already exists, don't add it again
-                        if pattern not in self.urls:
-                            self.include_pkgs.append(url)
+                if include_only_urls \
+                        and any(pattern in url for pattern in include_only_urls):
+                    self.include_urls.append(url)
 
-            if include_only and include_only_urls:
-                self.urls = self.include_pkgs
-                continue
-            elif include_only:
-                self.urls = self.include_pkgs
-                continue
-            elif include_only_urls:
-                self.urls = self.include_urls
-                continue
-            else:
-                self.urls.append(url)
+                if prefixes and os.path.basename(url).startswith(prefixes):
+                    self.include_pkgs.append(url)
 
-    def check_format(self):
-        with open(self.filename) as fp:
-            data = fp.read()
-
-        if '@EXPLICIT' not in data:
+        if not explicit:
             raise SpecFileFormatError('{0} is not a valid environment '
                                       'dump file.'.format(self.filename))
 
@@ -205,15 +260,92 @@ def download(url, dest):
 
     print('Downloading {0}'.format(url))
     # try/except something here... docs are unclear
-    #path, _ = urllib.request.urlretrieve(url, dest)
+    # Stream the body in large chunks rather than buffering the whole
+    # response (read()) or using urlretrieve's 8 KiB blocks
     with urllib.request.urlopen(url) as remote:
-        print("opened {}".format(url))
         with open(dest, 'w+b') as fp:
-            print("writing {}".format(dest))
-            fp.write(remote.read())
+            shutil.copyfileobj(remote, fp, DOWNLOAD_BUFSIZE)
 
     return dest
 
+
+def spool(url):
+    '''Download url into an anonymous temporary file.'''
+    assert isinstance(url, str)
+
+    print('Downloading {0}'.format(url))
+    with urllib.request.urlopen(url) as remote:
+        size = int(remote.headers.get('Content-Length') or 0)
+        if size > SPOOL_MAX:
+            fp = TemporaryFile()
+        else:
+            fp = SpooledTemporaryFile(max_size=SPOOL_MAX)
+
+        shutil.copyfileobj(remote, fp, DOWNLOAD_BUFSIZE)
+
+    fp.seek(0)
+    return fp
+
+
+def meta_cache_path(key):
+    return os.path.join(META_CACHE, key + '.yaml')
+
+
+def store_metadata(key, path):
+    '''Atomically publish a recipe to the metadata cache.'''
+    os.makedirs(META_CACHE, exist_ok=True)
+    fd, tmp = mkstemp(dir=META_CACHE)
+    os.close(fd)
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, meta_cache_path(key))
+
+
+@functools.lru_cache(maxsize=None)
+def load_metadata(key):
+    '''Parse a cached recipe. Duplicate packages share one MetaData.'''
+    with TemporaryDirectory() as tempdir:
+        meta_dest = os.path.join(tempdir, 'meta.yaml')
+        shutil.copyfile(meta_cache_path(key), meta_dest)
+        return parse_metadata(meta_dest)
+
+
+def parse_metadata(path):
+    with _metadata_lock:
+        return MetaData(path)
+
+
+def fetch_all(urls, max_workers=MAX_DOWNLOADS):
+    '''Construct a Package for each URL, downloading concurrently.'''
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(Package, urls))
+
+
+def download_all(urls, dest, max_workers=MAX_DOWNLOADS):
+    '''Download each URL into its own directory beneath dest.
+
+    Archive names are not unique (e.g. "v1.0.tar.gz"), so every download
+    receives a numbered subdirectory. Paths are yielded in order, and no
+    more than max_workers downloads are kept ahead of the consumer.
+    '''
+    def _download(index, url):
+        path = os.path.join(dest, str(index))
+        os.makedirs(path, exist_ok=True)
+        return download(url, os.path.join(path, os.path.basename(url)))
+
+    jobs = enumerate(urls)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = collections.deque()
+        for job in itertools.islice(jobs, max_workers):
+            futures.append(pool.submit(_download, *job))
+
+        while futures:
+            path = futures.popleft().result()
+            job = next(jobs, None)
+            if job is not None:
+                futures.append(pool.submit(_download, *job))
+            yield path
+
+
 def mkdest(orig, dest):
     dname = dest
     fname = os.path.basename(orig)
@@ -230,9 +362,156 @@ def mkdest(orig, dest):
 
 
 def untar(path, dest='.'):
+    '''Extract a tarball, writing small files from a thread pool.'''
     print('Extracting {0} to {1}'.format(path, dest))
-    with TarFile.open(path, 'r:*') as tarball:
-        tarball.extractall(dest)
+    dest = os.path.abspath(dest)
+    dirs = set()
+    pending = []
+    queued = set()
+    batch = []
+    batch_size = 0
+    in_flight = 0
+    budget = threading.Condition()
+
+    def _makedirs(path):
+        if path not in dirs:
+            os.makedirs(path, exist_ok=True)
+            dirs.add(path)
+
+    def _release(size):
+        nonlocal in_flight
+        with budget:
+            in_flight -= size
+            budget.notify_all()
+
+    def _submit():
+        nonlocal batch, batch_size, in_flight
+        if not batch:
+            return
+
+        size = batch_size
+        with budget:
+            # A lone batch larger than the budget is still let through
+            budget.wait_for(lambda: not in_flight
+                            or in_flight + size <= MAX_PENDING_BYTES)
+            in_flight += size
+
+        future = pool.submit(_write_files, batch)
+        future.add_done_callback(lambda _: _release(size))
+        pending.append(future)
+        batch = []
+        batch_size = 0
+
+    def _drain():
+        _submit()
+        for future in pending:
+            future.result()
+        pending.clear()
+        queued.clear()
+
+    # The stream keeps tarfile's default bufsize: it is measured before
+    # decompression, so a large one inflates without bound in memory
+    with ThreadPoolExecutor(max_workers=MAX_EXTRACT_WORKERS) as pool, \
+            TarFile.open(path, 'r|*', copybufsize=TAR_BUFSIZE) as tarball:
+        for member in tarball:
+            target = member_path(dest, member)
+
+            if member.isdir():
+                _makedirs(target)
+                continue
+
+            _makedirs(os.path.dirname(target))
+
+            if member.isfile() and member.size <= POOLED_FILE_MAX:
+                # Batches finish in any order; the last copy of a path wins
+                if target in queued:
+                    _drain()
+                queued.add(target)
+                data = tarball.extractfile(member).read()
+                batch.append((target, data, member.mode))
+                batch_size += len(data)
+                if len(batch) >= WRITE_BATCH \
+                        or batch_size >= WRITE_BATCH_BYTES:
+                    _submit()
+            elif member.isfile():
+                # An earlier member may still be queued for the same path
+                _drain()
+                with open(target, 'wb') as fp:
+                    shutil.copyfileobj(tarball.extractfile(member), fp,
+                                       TAR_BUFSIZE)
+                os.chmod(target, member.mode)
+            else:
+                # Links may refer to files that are still being written
+                _drain()
+                tarball.extract(member, dest, set_attrs=False)
+
+        _drain()
+
+
+def member_path(dest, member):
+    '''Return the extraction path of a tar member, refusing to escape dest.'''
+    root = os.path.realpath(dest)
+    path = os.path.normpath(os.path.join(dest, member.name))
+    parent = os.path.realpath(os.path.dirname(path))
+
+    if member.issym():
+        # The link itself replaces the final component; check its target
+        paths = [parent, os.path.realpath(os.path.join(parent,
+                                                       member.linkname))]
+    elif member.islnk():
+        paths = [os.path.realpath(path),
+                 os.path.realpath(os.path.join(root, member.linkname))]
+    else:
+        paths = [os.path.realpath(path)]
+
+    for x in paths:
+        inside = x == root or x.startswith(root + os.sep)
+        if os.path.isabs(member.name) or not inside:
+            raise ValueError('Unsafe archive member. '
+                             'Refusing to extract: "{0}"'.format(member.name))
+
+    return path
+
+
+def _write_files(batch):
+    '''Write each (path, data, mode) in batch using one descriptor apiece.'''
+    for path, data, mode in batch:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fchmod(fd, mode)
+        finally:
+            os.close(fd)
+
+
+def extract_member(fp, names, dest):
+    '''Write the most preferred of names found in a tar stream to dest.'''
+    found = None
+    with TarFile.open(fileobj=fp, mode='r|*',
+                      copybufsize=TAR_BUFSIZE) as tarball:
+        for member in tarball:
+            name = os.path.normpath(member.name)
+            # info/ files are ordered by size, not grouped by directory
+            if found and name.split('/', 1)[0] != found.split('/', 1)[0]:
+                break
+
+            # Non-matching members are skipped without being read
+            if name not in names or not member.isfile():
+                continue
+
+            if found and names.index(name) > names.index(found):
+                continue
+
+            with open(dest, 'wb') as data:
+                shutil.copyfileobj(tarball.extractfile(member), data,
+                                   TAR_BUFSIZE)
+            found = name
+            if name == names[0]:
+                break
+
+    return found
 
 
 def unzip(path, dest='.'):
@@ -241,7 +520,7 @@ def unzip(path, dest='.'):
         zipf.extractall(dest)
 
 
-def git(task, *args):
+def git(task, *args, cwd=None):
     assert isinstance(task, str)
     for arg in args:
         assert isinstance(arg, str)
@@ -252,17 +531,19 @@ def git(task, *args):
     for arg in args:
         cmd.append(arg)
 
-    if not safe_command(cmd):
+    cmdline = ' '.join(cmd)
+    if not safe_command(cmdline):
         raise ValueError('Unsafe execution attempt. '
-                         'Refusing to execute: "{0}"'.format(cmd))
+                         'Refusing to execute: "{0}"'.format(cmdline))
 
     if task not in tasks:
         raise ValueError('Invalid task: "{0}". Must be one of: '
                          '{1}'.format(task, ', '.join([x for x in tasks])))
 
-    print('Running: {0}'.format(' '.join(cmd)))
+    if VERBOSE:
+        print('Running: {0}'.format(cmdline))
     try:
-        output = subprocess.check_output(cmd,
+        output = subprocess.check_output(cmd, cwd=cwd,
                                          stderr=subprocess.STDOUT).decode()
     except subprocess.CalledProcessError as e:
         raise GitError(e)
@@ -271,137 +552,170 @@ def git(task, *args):
 
 
 def git_clone(url, path=''):
-    git('clone', '--recursive', url, path)
+    # Blobs are fetched lazily by checkout; history and tags remain local
+    # so offsets can still be resolved
+    git('clone', '--recursive', '--filter=blob:none', url, path)
+
+
+def clone_all(jobs, max_workers=MAX_CLONES):
+    '''Clone and check out each (url, path, tag, post_commit) concurrently.'''
+    if not jobs:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+        for _ in pool.map(lambda job: _clone_and_checkout(*job), jobs):
+            pass
+
+
+def _clone_and_checkout(url, path, tag, post_commit):
+    git_clone(url, path)
+
+    if isinstance(post_commit, int):
+        offset = git_commit_from_offset(path, tag, post_commit)
+    else:
+        offset = post_commit
+    git_checkout(path, offset)
 
 
 def git_checkout(path, rev):
     assert isinstance(path, str)
     assert isinstance(rev, str)
 
-    cwd = os.path.abspath(os.curdir)
     if not os.path.exists(path):
         raise FileNotFoundError(path)
 
-    os.chdir(path)
-    git('checkout', rev)
-    os.chdir(cwd)
+    git('checkout', rev, cwd=path)
 
 
 def git_commit_from_offset(path, tag, post_commit):
     assert isinstance(tag, str)
     assert isinstance(post_commit, int)
 
-    cwd = os.path.abspath(os.curdir)
     if not os.path.exists(path):
         raise FileNotFoundError(path)
 
-    os.chdir(path)
     name = os.path.basename(path).split('-')[0]
-    _revlist_tag = git('rev-list', '--tags', '--max-count=1').strip()
-    _latest_tag = git('describe', '--tags', _revlist_tag).strip()
+    _revlist_tag = git('rev-list', '--tags', '--max-count=1', cwd=path).strip()
+    _latest_tag = git('describe', '--tags', _revlist_tag, cwd=path).strip()
     tags = [tag, 'v' + tag, '-'.join([name, tag]), name + '-' + 'v' + tag, _latest_tag]
     offset = tag + '..' + 'master'
-    result = ''
-
-    if not post_commit:
-        for salvo in tags:
-            try:
-                result = git('log', '--oneline', salvo).splitlines()[0]
-                break
-            except GitError:
-                continue
-
-        rev, message = result.split(' ', 1)
-        os.chdir(cwd)
-        return rev
 
     magic_post_commit, bad_magic = filter_commit(post_commit)
     if bad_magic:
-        result = git('log', '--oneline').splitlines()
-        rev, message = result[magic_post_commit].split(' ', 1)
-        os.chdir(cwd)
-        return rev
+        return git_rev_at(path, 'HEAD', magic_post_commit)
 
     for salvo in tags:
         try:
-            result = git('log', '--oneline', salvo).splitlines()
+            # Probe for the tag; also the number of commits it contains
+            tail = git_rev_count(path, salvo)
             break
         except GitError:
             continue
+    else:
+        raise GitError('Unable to locate tag: {0}'.format(tag))
+
+    if not post_commit:
+        return git_rev_at(path, salvo)
 
-    tail = len(result)
-    rev, message = result[tail - post_commit].rstrip().split(' ', 1)
+    rev = git_rev_at(path, salvo, tail - post_commit)
     print("{} - {} = {}".format(tail, post_commit, tail - post_commit))
 
-    os.chdir(cwd)
     return rev
 
 
+def git_rev_count(path, rev):
+    '''Return the number of commits reachable from rev.'''
+    commits = _walk(path, rev)
+    if commits is not None:
+        return len(commits)
+
+    return int(git('rev-list', '--count', rev, cwd=path))
+
+
+def git_rev_at(path, rev, skip=0):
+    '''Return the commit skip places behind rev, newest first.'''
+    commits = _walk(path, rev)
+    if commits is not None:
+        return commits[skip] if skip < len(commits) else ''
+
+    # Let git walk to the commit instead of listing the whole history
+    return git('rev-list', '--max-count=1', '--skip={0}'.format(skip), rev,
+               cwd=path).strip()
+
+
+def _walk(path, rev):
+    '''List the commits reachable from rev with pygit2, or None.'''
+    if pygit2 is None:
+        return None
+
+    try:
+        repo = pygit2.Repository(path)
+        commit = repo.revparse_single(rev).peel(pygit2.Commit)
+    except (KeyError, ValueError):
+        raise GitError('Unknown revision: {0}'.format(rev))
+    except pygit2.GitError:
+        return None
+
+    return _walk_commits(path, str(commit.id))
+
+
+@functools.lru_cache(maxsize=None)
+def _walk_commits(path, oid):
+    # Keyed by commit id rather than ref, so a checkout never stales it
+    repo = pygit2.Repository(path)
+    return [str(x.id) for x in repo.walk(oid, pygit2.GIT_SORT_TIME)]
+
+
 def filter_commit(x):
-    has_magic = False
-    if isinstance(x, str):
-        return x, has_magic
+    '''Unpack a post-commit count tagged with BAD_MAGIC.
 
-    if (x & 0xffffffff) == BAD_MAGIC:
-        print('BAD_MAGIC ({0:#08x}) detected!'.format(BAD_MAGIC))
-        x >>= 32
-        has_magic = True
+    Tagged counts are packed as (count << 32) | BAD_MAGIC. Returns the
+    count and whether it was tagged. Strings (commit hashes) pass through.
+    '''
+    if isinstance(x, str):
+        return x, False
 
-    return x, has_magic
+    has_magic = (x & _MASK32) == BAD_MAGIC
+    return x >> (32 * has_magic), has_magic
 
 
 def safe_command(x):
-    assert isinstance(x, list)
-
-    for ch in ESCAPE_CHARS:
-        cmdtmp = ' '.join(x)
-        if ch in cmdtmp:
-            return False
-
-    return True
-
-def copytree(src, dst, symlinks=False):
-    names = os.listdir(src)
-    os.makedirs(dst)
-    errors = []
-    for name in names:
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, name)
-        try:
-            if symlinks and os.path.islink(srcname):
-                linkto = os.readlink(srcname)
-                os.symlink(linkto, dstname)
-            elif os.path.isdir(srcname):
-                shutil.copytree(srcname, dstname, symlinks)
-            else:
-                shutil.copy2(srcname, dstname)
-            # XXX What about devices, sockets etc.?
-        except OSError as why:
-            errors.append((srcname, dstname, str(why)))
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except shutil.Error as err:
-            errors.extend(err.args[0])
+    '''Accepts an argument list or an already joined command line.'''
+    assert isinstance(x, (list, str))
+
+    if isinstance(x, list):
+        x = ' '.join(x)
+
+    return _UNSAFE.search(x) is None
+
+def link_or_copy(src, dst):
+    '''Hard link src to dst, or copy it if linking fails'''
     try:
-        shutil.copystat(src, dst)
-    except OSError as why:
-        # can't copy file access times on Windows
-        if why.winerror is None:
-            errors.extend((src, dst, str(why)))
-    if errors:
-        raise Error(errors)
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+    return dst
 
 def sloccount(path):
     cmd = ['sloccount', '--multiproject', path]
+    cmdline = ' '.join(cmd)
 
-    if not safe_command(cmd):
+    if not safe_command(cmdline):
         raise ValueError('Unsafe execution attempt. '
-                         'Refusing to execute: "{0}"'.format(cmd))
+                         'Refusing to execute: "{0}"'.format(cmdline))
 
-    print('Running: {0}'.format(' '.join(cmd)))
-    output = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
+    if VERBOSE:
+        print('Running: {0}'.format(cmdline))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, bufsize=1,
+                          universal_newlines=True) as proc:
+        # Yield the report as it is produced instead of buffering it
+        for line in proc.stdout:
+            yield line
 
-    return output
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
 
 if __name__ == '__main__':
     import argparse
@@ -429,7 +743,6 @@ if __name__ == '__main__':
                         help='Retain a copy of the work directory')
     args = parser.parse_args()
 
-    packages = []
     specfile = SpecFile(args.specfile, args.include_pkgs, args.include_urls)
 
 
@@ -437,13 +750,13 @@ if __name__ == '__main__':
         print('Nothing to do.')
         exit(1)
 
-    for url in specfile:
-        pkg = Package(url)
-        packages.append(pkg)
+    packages = fetch_all(specfile)
 
     with TemporaryDirectory() as tempdir:
         total_processed = 0
         total_skipped = 0
+        clones = []
+        archives = []
         for pkg in packages:
             if pkg.metadata is None:
                 print('No metadata. Skipping {0}'.format(pkg.filename))
@@ -468,51 +781,56 @@ if __name__ == '__main__':
                 # I tried to consolidate this block but smoke poured out
                 # TODO: Improve this
                 if bad_magic:
+                    print('BAD_MAGIC ({0:#08x}) detected!'.format(BAD_MAGIC))
                     dest = os.path.join(tempdir, '-'.join([pkg.metadata.name(),
                                         tag, str(magic_post_commit)]))
                 else:
                     dest = os.path.join(tempdir, '-'.join([pkg.metadata.name(),
                                         tag, str(post_commit)]))
 
-                git_clone(url, dest)
-
-                if isinstance(post_commit, int):
-                    offset = git_commit_from_offset(dest, tag, post_commit)
-                else:
-                    offset = post_commit
-                git_checkout(dest, offset)
+                # Repositories are cloned together once every package is known
+                clones.append((url, dest, tag, post_commit))
 
             elif pkg.source_type == 'archive':
                 # Source URLs can be arbitrary files. It's awesome. Thanks continuum!
                 base = os.path.basename(url)
-                # tempdir2 is truly temporary. It's only used to download the archive.
-                with TemporaryDirectory() as tempdir2:
-                    dest = os.path.join(tempdir2, base)
-                    archive = download(url, dest)
-                    if '.tar' in base:
-                        untar(archive, tempdir)
-                    elif '.zip' in base:
-                        unzip(archive, tempdir)
-                    else:
-                        continue
-
-
-            total_processed += 1
-            print()
+                if '.tar' not in base and '.zip' not in base:
+                    continue
+
+                # Archives are fetched together once every package is known
+                archives.append(url)
+
+        clone_all(clones)
+        total_processed += len(clones)
+
+        # tempdir2 is truly temporary. It's only used to download the archives.
+        with TemporaryDirectory() as tempdir2:
+            for archive in download_all(archives, tempdir2):
+                if '.tar' in os.path.basename(archive):
+                    untar(archive, tempdir)
+                else:
+                    unzip(archive, tempdir)
+
+                # Don't hold every archive on disk until the last is done
+                os.remove(archive)
+                total_processed += 1
+                print()
 
         print('\nProccessed: {0}\nSkipped: {1}\n'.format(total_processed, total_skipped))
 
         if total_processed:
             #from glob import glob
             #result = sloccount(' '.join(glob(os.path.join(tempdir, '*'))))
-            result = sloccount(tempdir)
-            print(result)
+            for line in sloccount(tempdir):
+                print(line, end='')
+            print()
         else:
             print('sloccount report not generated.')
             exit(1)
 
         if args.keep_files:
             kdir = '-'.join([os.path.basename(os.path.splitext(args.specfile)[0]), 'BR' ,str(int(time.time()))])
-            copytree(tempdir, kdir, symlinks=True)
+            shutil.copytree(tempdir, kdir, symlinks=True,
+                            copy_function=link_or_copy)
 
         exit(0)